@@ -1,14 +1,58 @@
+import hashlib
+import io
 import os
+import shutil
+import subprocess
+import ctranslate2
+import numpy as np
 import streamlit as st
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import tempfile
-from pydub import AudioSegment
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Configuraciones iniciales
 warnings.filterwarnings('ignore', category=SyntaxWarning)
 os.environ['KMP_DUPLICATE_LIB_OK']="TRUE"
 
+# Frecuencia de muestreo que espera Whisper
+SAMPLE_RATE = 16000
+
+# Parámetros de decodificación por lotes: el VAD corta el audio en silencios,
+# en fragmentos de hasta CHUNK_LENGTH segundos, por lo que no se pierden
+# palabras en los bordes y no hace falta solapar fragmentos.
+CHUNK_LENGTH = 30
+BATCH_SIZE = 16
+
+# Los silencios de más de medio segundo se descartan antes de decodificar
+VAD_PARAMETERS = {"min_silence_duration_ms": 500}
+
+# Cálculo cuantizado: float16 en GPU, int8 en CPU, si el dispositivo lo soporta
+DEVICE = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+COMPUTE_TYPES = {
+    "cuda": ["float16", "int8_float16", "int8", "float32"],
+    "cpu": ["int8", "int8_float32", "float32"],
+}
+SUPPORTED_COMPUTE_TYPES = [
+    compute_type for compute_type in COMPUTE_TYPES[DEVICE]
+    if compute_type in ctranslate2.get_supported_compute_types(DEVICE)
+]
+DEFAULT_COMPUTE_TYPE = SUPPORTED_COMPUTE_TYPES[0] if SUPPORTED_COMPUTE_TYPES else "default"
+
+# El modelo en caché se comparte entre sesiones. En GPU dos workers de
+# CTranslate2 atienden transcripciones simultáneas (limitado por la VRAM); en
+# CPU un solo worker usa todos los núcleos, porque cada transcripción solo
+# ocupa un worker y repartir hilos frenaría al usuario que está solo
+CPU_COUNT = os.cpu_count() or 1
+NUM_WORKERS = 2 if DEVICE == "cuda" else 1
+
+# Transcripciones simultáneas entre todas las sesiones: en GPU lo limita la
+# VRAM; en CPU cada una ya usa todos los núcleos, así que se atienden en cola
+MAX_CONCURRENT_TRANSCRIPTIONS = 2 if DEVICE == "cuda" else 1
+
 # Configuración de la página
 st.set_page_config(
     page_title="Transcriptor de Video",
@@ -20,50 +64,87 @@ st.set_page_config(
 # Funciones auxiliares
 def format_time(seconds):
     """Convierte segundos a formato HH:MM:SS"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = int(seconds % 60)
+    hours, seconds = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(seconds, 60)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
-@st.cache_data
-def load_whisper_model(model_size):
-    """Carga el modelo Whisper con caché"""
-    return WhisperModel(model_size)
+def get_compute_type():
+    """Obtiene el tipo de cálculo del parámetro oculto ?compute_type= de la URL"""
+    requested = st.experimental_get_query_params().get("compute_type", [None])[0]
+    if requested in SUPPORTED_COMPUTE_TYPES:
+        return requested
+    return DEFAULT_COMPUTE_TYPE
 
-def extract_audio(video_file):
-    """Extrae el audio de un archivo de video"""
+# Como mucho dos modelos residentes: ?compute_type= lo puede fijar cualquier visitante
+@st.cache_resource(max_entries=2)
+def load_whisper_model(model_size, device=DEVICE, compute_type=DEFAULT_COMPUTE_TYPE):
+    """Carga el modelo Whisper una sola vez y lo comparte entre ejecuciones"""
+    return WhisperModel(
+        model_size,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=CPU_COUNT,
+        num_workers=NUM_WORKERS
+    )
+
+@st.cache_resource
+def ffmpeg_available():
+    """Comprueba una sola vez por proceso que ffmpeg está en el PATH"""
+    return shutil.which("ffmpeg") is not None
+
+@st.cache_resource
+def get_transcription_slots():
+    """Semáforo compartido entre sesiones que limita las transcripciones simultáneas"""
+    return threading.BoundedSemaphore(MAX_CONCURRENT_TRANSCRIPTIONS)
+
+@contextmanager
+def transcription_slot():
+    """Espera un worker libre antes de transcribir para no saturar la GPU/CPU"""
+    slots = get_transcription_slots()
+    waiting = None
+    if not slots.acquire(blocking=False):
+        waiting = st.info("Otras transcripciones en curso, esperando turno...")
+        slots.acquire()
+    # Cualquier llamada a Streamlit puede lanzar RerunException/StopException,
+    # así que desde aquí el turno se libera pase lo que pase
     try:
-        # Crear directorio temporal si no existe
-        temp_dir = tempfile.mkdtemp()
-        video_path = os.path.join(temp_dir, "temp_video.mp4")
-        audio_path = os.path.join(temp_dir, "temp_audio.wav")
+        if waiting is not None:
+            waiting.empty()
+        yield
+    finally:
+        slots.release()
 
+def extract_audio(video_file, temp_dir):
+    """Extrae el audio de un archivo de video"""
+    video_path = os.path.join(temp_dir, "temp_video")
+    try:
         # Guardar video
         with open(video_path, "wb") as f:
             f.write(video_file.getbuffer())
 
-        # Convertir a audio
-        audio = AudioSegment.from_file(video_path)
-        audio = audio.set_channels(1).set_frame_rate(16000)
-        audio.export(audio_path, format='wav')
-
-        return audio_path, temp_dir
+        # Decodificar directamente a PCM mono de 16 kHz sin pasar por un WAV
+        result = subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-i", video_path,
+             "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"],
+            capture_output=True,
+            check=True
+        )
+        audio = np.frombuffer(result.stdout, np.int16).astype(np.float32)
+        audio /= 32768.0
+        return audio
+    except subprocess.CalledProcessError as e:
+        st.error(f"Error al procesar el audio: {e.stderr.decode(errors='replace')}")
+        return None
     except Exception as e:
         st.error(f"Error al procesar el audio: {str(e)}")
-        return None, None
-
-def cleanup_files(temp_dir):
-    """Limpia archivos temporales"""
-    if temp_dir and os.path.exists(temp_dir):
-        try:
-            for file in os.listdir(temp_dir):
-                os.remove(os.path.join(temp_dir, file))
-            os.rmdir(temp_dir)
-        except Exception as e:
-            st.warning(f"No se pudieron eliminar algunos archivos temporales: {str(e)}")
+        return None
 
 def main():
     st.title("Transcriptor de Video a Texto 🎥➡️📝")
+
+    if not ffmpeg_available():
+        st.error("No se encontró ffmpeg. Instálalo y asegúrate de que está en el PATH.")
+        st.stop()
     
     # Contenedor para configuraciones
     with st.container():
@@ -101,49 +182,86 @@ def main():
     # Estado de la aplicación
     if 'transcription_done' not in st.session_state:
         st.session_state.transcription_done = False
-    
-    if 'temp_dir' not in st.session_state:
-        st.session_state.temp_dir = None
 
     # Procesar video
     if video_file and st.button("Transcribir Video", help="Iniciar proceso de transcripción"):
         try:
-            # Limpiar estado anterior
-            if st.session_state.temp_dir:
-                cleanup_files(st.session_state.temp_dir)
-            
-            with st.spinner("Procesando video..."):
-                # Extraer audio
-                audio_path, temp_dir = extract_audio(video_file)
-                st.session_state.temp_dir = temp_dir
-
-                if audio_path:
-                    # Cargar modelo
-                    model = load_whisper_model(model_size)
+            # Reutilizar la transcripción si ya se procesó el mismo video con la misma configuración
+            compute_type = get_compute_type()
+            video_hash = hashlib.blake2b(video_file.getbuffer(), digest_size=16).hexdigest()
+            cache_key = (video_hash, model_size, language_map[language], compute_type)
+            transcripts = st.session_state.setdefault('transcripts', {})
+
+            if cache_key in transcripts:
+                st.session_state.transcript = transcripts[cache_key]
+                st.session_state.transcription_done = True
+            else:
+                with st.spinner("Procesando video..."):
+                    # Extraer audio mientras se carga el modelo
+                    with tempfile.TemporaryDirectory() as temp_dir, ThreadPoolExecutor(
+                        max_workers=2,
+                        initializer=add_script_run_ctx,
+                        initargs=(None, get_script_run_ctx())
+                    ) as pool:
+                        fut_audio = pool.submit(extract_audio, video_file, temp_dir)
+                        fut_model = pool.submit(
+                            load_whisper_model, model_size, compute_type=compute_type
+                        )
+                        audio = fut_audio.result()
+                        model = fut_model.result()
+
+                    if audio is not None:
+                        batched = BatchedInferencePipeline(model=model)
                     
-                    # Transcribir
-                    segments, _ = model.transcribe(
-                        audio_path,
-                        language=language_map[language]
-                    )
-
-                    # Formatear resultados
-                    transcript = "\n".join([
-                        f"[{format_time(segment.start)} - {format_time(segment.end)}] {segment.text}"
-                        for segment in segments
-                    ])
-
-                    # Guardar en session state
-                    st.session_state.transcript = transcript
-                    st.session_state.transcription_done = True
-
-                    # Limpiar archivos
-                    cleanup_files(temp_dir)
+                        # Transcribir (VAD + decodificación por lotes); los segmentos
+                        # se decodifican al iterarlos, así que el turno cubre el bucle
+                        with transcription_slot():
+                            segments, info = batched.transcribe(
+                                audio,
+                                batch_size=BATCH_SIZE,
+                                chunk_length=CHUNK_LENGTH,
+                                without_timestamps=False,
+                                vad_filter=True,
+                                vad_parameters=dict(VAD_PARAMETERS),
+                                language=language_map[language]
+                            )
+
+                            # La cuantización puede degradar la detección de idioma
+                            if language_map[language] is None and info.language_probability < 0.5:
+                                st.warning(
+                                    f"Idioma detectado con baja confianza: {info.language} "
+                                    f"({info.language_probability:.0%}). Considera seleccionar el idioma manualmente."
+                                )
+
+                            # Mostrar los segmentos a medida que se decodifican
+                            progress_bar = st.progress(0.0)
+                            live = st.empty()
+                            buffer = io.StringIO()
+                            for segment in segments:
+                                buffer.write(
+                                    f"[{format_time(segment.start)} - {format_time(segment.end)}] {segment.text}\n"
+                                )
+                                # Los segmentos llegan en ráfagas por lote; Streamlit agrupa
+                                # las actualizaciones consecutivas del mismo placeholder
+                                live.text_area(
+                                    "Transcripción en progreso...",
+                                    buffer.getvalue(),
+                                    height=400,
+                                    disabled=True
+                                )
+                                if info.duration:
+                                    progress_bar.progress(min(segment.end / info.duration, 1.0))
+                            progress_bar.progress(1.0)
+                            live.empty()
+                        transcript = buffer.getvalue().rstrip("\n")
+
+                        # Guardar en session state
+                        transcripts[cache_key] = transcript
+                        st.session_state.transcript = transcript
+                        st.session_state.transcription_done = True
                     
         except Exception as e:
             st.error(f"Error durante la transcripción: {str(e)}")
-            if st.session_state.temp_dir:
-                cleanup_files(st.session_state.temp_dir)
 
     # Mostrar resultados
     if st.session_state.get('transcription_done', False):